@@ -1,67 +1,122 @@
+import asyncio
+import logging
 import os
-from fastapi import FastAPI, HTTPException
+from contextlib import asynccontextmanager, suppress
+from types import MappingProxyType
+from fastapi import BackgroundTasks, FastAPI, HTTPException, Request
 from fastapi.middleware.cors import CORSMiddleware
-from typing import Dict, Any
+from fastapi.responses import ORJSONResponse
+from typing import Dict, NamedTuple, Tuple
 from bson import ObjectId
-import requests
+from pymongo.errors import DuplicateKeyError
+import httpx
+import numpy as np
+import orjson
+from tenacity import retry, retry_if_exception_type, stop_after_attempt, stop_after_delay, wait_exponential
 
-from database import db, create_document, get_documents
-from schemas import OrderCreate, Order, PaymentInitRequest, PaymentInitResponse, PaymentVerifyResponse
+from database import db, database_url, database_name, create_document, get_documents
+from schemas import OrderCreate, Order, PaymentInitRequest, PaymentInitResponse, PaymentVerifyResponse, EtaBatchRequest
 
-app = FastAPI()
+logger = logging.getLogger(__name__)
+
+# Environment is read once; importing database has already run load_dotenv()
+PAYSTACK_SECRET_KEY = os.getenv("PAYSTACK_SECRET_KEY")
+PORT = int(os.getenv("PORT", 8000))
+ALLOWED_ORIGINS = [o.strip() for o in os.getenv("ALLOWED_ORIGINS", "").split(",") if o.strip()] or ["*"]
+
+async def _ensure_indexes() -> None:
+    try:
+        await db["order"].create_index("payment_reference", sparse=True)
+    except Exception:
+        logger.exception("Could not create order indexes; serving without them")
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    # Shared HTTP client so Paystack calls reuse keep-alive connections
+    app.state.http = httpx.AsyncClient(
+        timeout=10,
+        limits=httpx.Limits(max_keepalive_connections=20, max_connections=100),
+    )
+    # Built in the background so an unreachable Mongo doesn't hold up startup
+    index_task = asyncio.create_task(_ensure_indexes()) if db is not None else None
+    yield
+    if index_task is not None:
+        index_task.cancel()
+        with suppress(asyncio.CancelledError):
+            await index_task
+    await app.state.http.aclose()
+
+app = FastAPI(default_response_class=ORJSONResponse, lifespan=lifespan)
 
 app.add_middleware(
     CORSMiddleware,
-    allow_origins=["*"],
-    allow_credentials=True,
-    allow_methods=["*"],
-    allow_headers=["*"],
+    allow_origins=ALLOWED_ORIGINS,
+    # Credentials are not allowed with a wildcard origin
+    allow_credentials=ALLOWED_ORIGINS != ["*"],
+    allow_methods=["GET", "POST"],
+    allow_headers=["Authorization", "Content-Type"],
+    max_age=86400,
 )
 
 @app.get("/")
 def read_root():
     return {"message": "Horion Farms API running"}
 
+# /test payloads that only depend on import-time state
+_TEST_BASE = MappingProxyType({
+    "backend": "✅ Running",
+    "database": "❌ Not Available",
+    "database_url": None,
+    "database_name": None,
+    "connection_status": "Not Connected",
+    "collections": (),
+})
+_TEST_DB_BASE = MappingProxyType({
+    **_TEST_BASE,
+    "database": "✅ Available",
+    "database_url": "✅ Set" if database_url else "❌ Not Set",
+    "database_name": database_name or "❌ Not Set",
+})
+
 @app.get("/test")
-def test_database():
-    response = {
-        "backend": "✅ Running",
-        "database": "❌ Not Available",
-        "database_url": None,
-        "database_name": None,
-        "connection_status": "Not Connected",
-        "collections": []
-    }
+async def test_database(collections: bool = False):
+    if db is None:
+        return {**_TEST_BASE, "database": "⚠️  Available but not initialized"}
     try:
-        if db is not None:
-            response["database"] = "✅ Available"
-            response["database_url"] = "✅ Set" if os.getenv("DATABASE_URL") else "❌ Not Set"
-            response["database_name"] = os.getenv("DATABASE_NAME") or "❌ Not Set"
+        await db.command("ping")
+        names = ()
+        # Listing collections is a server-side enumeration; only on request
+        if collections:
+            # batchSize keeps the server from shipping a full first batch
+            cursor = await db.list_collections(nameOnly=True, cursor={"batchSize": 10})
             try:
-                collections = db.list_collection_names()
-                response["collections"] = collections[:10]
-                response["database"] = "✅ Connected & Working"
-                response["connection_status"] = "Connected"
-            except Exception as e:
-                response["database"] = f"⚠️  Connected but Error: {str(e)[:80]}"
-        else:
-            response["database"] = "⚠️  Available but not initialized"
+                names = [c["name"] for c in await cursor.to_list(length=10)]
+            finally:
+                await cursor.close()
     except Exception as e:
-        response["database"] = f"❌ Error: {str(e)[:80]}"
-
-    return response
+        return {**_TEST_DB_BASE, "database": f"⚠️  Connected but Error: {str(e)[:80]}"}
+    return {
+        **_TEST_DB_BASE,
+        "database": "✅ Connected & Working",
+        "connection_status": "Connected",
+        "collections": names,
+    }
 
 # ---------- Delivery ETA (Nigeria cities) ----------
 
-NIGERIA_CITY_HUBS: Dict[str, Dict[str, Any]] = {
-    # hub => { base_hours, per_km_min, cold_chain }
-    "Lagos": {"base_hours": 6, "per_km_min": 1.2, "cold_chain": True},
-    "Abuja": {"base_hours": 12, "per_km_min": 1.0, "cold_chain": True},
-    "Port Harcourt": {"base_hours": 12, "per_km_min": 1.1, "cold_chain": True},
-    "Ibadan": {"base_hours": 8, "per_km_min": 1.0, "cold_chain": True},
-    "Kano": {"base_hours": 16, "per_km_min": 1.1, "cold_chain": True},
-    "Enugu": {"base_hours": 14, "per_km_min": 1.0, "cold_chain": True},
-    "Benin City": {"base_hours": 10, "per_km_min": 1.0, "cold_chain": True},
+class HubCfg(NamedTuple):
+    base_hours: int
+    per_km_min: float
+    cold_chain: bool
+
+NIGERIA_CITY_HUBS: Dict[str, HubCfg] = {
+    "Lagos": HubCfg(6, 1.2, True),
+    "Abuja": HubCfg(12, 1.0, True),
+    "Port Harcourt": HubCfg(12, 1.1, True),
+    "Ibadan": HubCfg(8, 1.0, True),
+    "Kano": HubCfg(16, 1.1, True),
+    "Enugu": HubCfg(14, 1.0, True),
+    "Benin City": HubCfg(10, 1.0, True),
 }
 
 CITY_COORDS = {
@@ -74,16 +129,43 @@ CITY_COORDS = {
     "Benin City": (6.3350, 5.6037),
 }
 
-from math import radians, sin, cos, sqrt, atan2
+from functools import lru_cache
+from math import radians, sin, cos, sqrt, asin
+
+# city => (lat_rad, lon_rad, cos(lat_rad)), computed once at import
+CITY_RAD = {
+    name: (radians(lat), radians(lon), cos(radians(lat)))
+    for name, (lat, lon) in CITY_COORDS.items()
+}
+
+# Array views of the same tables for the batch endpoint, indexed via CITY_INDEX
+CITY_INDEX = {name: i for i, name in enumerate(CITY_COORDS)}
+LATS = np.radians(np.array([lat for lat, _ in CITY_COORDS.values()]))
+LONS = np.radians(np.array([lon for _, lon in CITY_COORDS.values()]))
+HUB_BASE_HOURS = np.array([NIGERIA_CITY_HUBS[name].base_hours for name in CITY_COORDS], dtype=float)
+HUB_PER_KM_MIN = np.array([NIGERIA_CITY_HUBS[name].per_km_min for name in CITY_COORDS])
 
-def haversine_km(lat1: float, lon1: float, lat2: float, lon2: float) -> float:
+def haversine_km(p1: Tuple[float, float, float], p2: Tuple[float, float, float]) -> float:
     R = 6371.0
-    dlat = radians(lat2 - lat1)
-    dlon = radians(lon2 - lon1)
-    a = sin(dlat/2)**2 + cos(radians(lat1)) * cos(radians(lat2)) * sin(dlon/2)**2
-    c = 2 * atan2(sqrt(1-a), sqrt(a)) if False else 2 * atan2(sqrt(a), sqrt(1-a))
+    lat1, lon1, cos_lat1 = p1
+    lat2, lon2, cos_lat2 = p2
+    a = sin((lat2 - lat1)/2)**2 + cos_lat1 * cos_lat2 * sin((lon2 - lon1)/2)**2
+    # Clamp: rounding can push a just above 1 near antipodal points
+    c = 2 * asin(sqrt(min(1.0, a)))
     return R * c
 
+def haversine_km_batch(lat1: np.ndarray, lon1: np.ndarray, lat2: np.ndarray, lon2: np.ndarray) -> np.ndarray:
+    a = np.sin((lat2 - lat1)/2)**2 + np.cos(lat1) * np.cos(lat2) * np.sin((lon2 - lon1)/2)**2
+    return 2 * 6371.0 * np.arcsin(np.sqrt(np.minimum(1.0, a)))
+
+@lru_cache(maxsize=128)
+def _eta_core(city: str, hub: str) -> Tuple[float, float, bool]:
+    """Rounded (distance_km, eta_hours, cold_chain) for a validated city/hub pair."""
+    hub_cfg = NIGERIA_CITY_HUBS.get(hub, NIGERIA_CITY_HUBS["Lagos"])
+    km = haversine_km(CITY_RAD[hub], CITY_RAD[city])
+    hours = hub_cfg.base_hours + (km * hub_cfg.per_km_min) / 60.0
+    return round(km, 1), round(hours, 1), hub_cfg.cold_chain
+
 @app.get("/eta")
 def eta(city: str, hub: str = "Lagos"):
     """
@@ -92,25 +174,64 @@ def eta(city: str, hub: str = "Lagos"):
     """
     if hub not in CITY_COORDS or city not in CITY_COORDS:
         raise HTTPException(status_code=400, detail="Unsupported city or hub")
-    hub_cfg = NIGERIA_CITY_HUBS.get(hub, NIGERIA_CITY_HUBS["Lagos"]) 
-    hlat, hlon = CITY_COORDS[hub]
-    clat, clon = CITY_COORDS[city]
-    km = haversine_km(hlat, hlon, clat, clon)
-    hours = hub_cfg["base_hours"] + (km * hub_cfg["per_km_min"]) / 60.0
-    return {"city": city, "hub": hub, "distance_km": round(km, 1), "eta_hours": round(hours, 1), "cold_chain": hub_cfg["cold_chain"]}
+    km, hours, cold_chain = _eta_core(city, hub)
+    return {"city": city, "hub": hub, "distance_km": km, "eta_hours": hours, "cold_chain": cold_chain}
+
+@app.post("/eta/batch")
+def eta_batch(payload: EtaBatchRequest):
+    """
+    Batch variant of /eta: computes every (city, hub) pair in one vectorized pass.
+    """
+    try:
+        city_idx = np.array([CITY_INDEX[p.city] for p in payload.pairs], dtype=np.intp)
+        hub_idx = np.array([CITY_INDEX[p.hub] for p in payload.pairs], dtype=np.intp)
+    except KeyError:
+        raise HTTPException(status_code=400, detail="Unsupported city or hub")
+    km = haversine_km_batch(LATS[hub_idx], LONS[hub_idx], LATS[city_idx], LONS[city_idx])
+    hours = HUB_BASE_HOURS[hub_idx] + (km * HUB_PER_KM_MIN[hub_idx]) / 60.0
+    return [
+        {
+            "city": p.city,
+            "hub": p.hub,
+            "distance_km": round(k, 1),
+            "eta_hours": round(h, 1),
+            "cold_chain": NIGERIA_CITY_HUBS[p.hub].cold_chain,
+        }
+        for p, k, h in zip(payload.pairs, km.tolist(), hours.tolist())
+    ]
 
 # ---------- Orders & Payments ----------
 
+def to_kobo(amount: float) -> int:
+    """Naira amount as integer kobo, so money comparisons are exact."""
+    return int(round(amount * 100))
+
+async def _insert_order(oid: ObjectId, order_doc: Order, attempts: int = 3) -> None:
+    """Background insert for create_order; the client already holds oid, so failures are logged with it."""
+    data = {"_id": oid, **order_doc.model_dump()}
+    for attempt in range(1, attempts + 1):
+        try:
+            await create_document("order", data)
+            return
+        except DuplicateKeyError:
+            # An earlier attempt landed even though it reported an error
+            return
+        except Exception:
+            if attempt == attempts:
+                logger.exception("Order %s was not saved after %d attempts", oid, attempts)
+                return
+            logger.warning("Saving order %s failed (attempt %d/%d), retrying", oid, attempt, attempts, exc_info=True)
+            await asyncio.sleep(0.2 * attempt)
+
 @app.post("/orders")
-def create_order(order: OrderCreate):
+async def create_order(order: OrderCreate, background_tasks: BackgroundTasks):
     if db is None:
         raise HTTPException(status_code=500, detail="Database not configured")
-    # Basic recompute/validation
-    subtotal = sum([it.unit_price * it.quantity for it in order.items])
-    if abs(subtotal - order.subtotal) > 1e-2:
+    # Basic recompute/validation, in integer kobo
+    subtotal_kobo = to_kobo(order.subtotal)
+    if sum(to_kobo(it.unit_price) * it.quantity for it in order.items) != subtotal_kobo:
         raise HTTPException(status_code=400, detail="Subtotal mismatch")
-    total = order.subtotal + order.delivery_fee
-    if abs(total - order.total) > 1e-2:
+    if subtotal_kobo + to_kobo(order.delivery_fee) != to_kobo(order.total):
         raise HTTPException(status_code=400, detail="Total mismatch")
 
     order_doc = Order(
@@ -121,15 +242,47 @@ def create_order(order: OrderCreate):
         total=order.total,
     )
 
-    oid = create_document("order", order_doc)
-    return {"order_id": oid, "status": "pending"}
+    # Id is assigned here so the insert can run after the response is sent;
+    # until it lands, /payments/init for this order_id returns 404
+    oid = ObjectId()
+    background_tasks.add_task(_insert_order, oid, order_doc)
+    return {"order_id": str(oid), "status": "pending"}
+
+# Per attempt: at most ~5s (1s pool wait + 1s connect + 3s read). No retry
+# starts once 4s have elapsed, so a retried call ends within ~9.2s, under the
+# single 10s call it replaced.
+PAYSTACK_TIMEOUT = httpx.Timeout(3.0, connect=1.0, pool=1.0)
+
+@retry(
+    stop=stop_after_attempt(3) | stop_after_delay(4),
+    wait=wait_exponential(multiplier=0.1, max=1),
+    # POST is not idempotent: only retry when the request never reached Paystack
+    retry=retry_if_exception_type((httpx.ConnectError, httpx.ConnectTimeout, httpx.PoolTimeout)),
+    reraise=True,
+)
+async def _paystack_post(client: httpx.AsyncClient, url: str, **kwargs) -> httpx.Response:
+    """POST to Paystack, retrying only failures to connect."""
+    return await client.post(url, timeout=PAYSTACK_TIMEOUT, **kwargs)
+
+@retry(
+    stop=stop_after_attempt(3) | stop_after_delay(4),
+    wait=wait_exponential(multiplier=0.1, max=1),
+    retry=retry_if_exception_type((httpx.TimeoutException, httpx.ConnectError)),
+    reraise=True,
+)
+async def _paystack_get(client: httpx.AsyncClient, url: str, **kwargs) -> httpx.Response:
+    """GET from Paystack, retrying transient network failures with exponential backoff."""
+    return await client.get(url, timeout=PAYSTACK_TIMEOUT, **kwargs)
 
 @app.post("/payments/init", response_model=PaymentInitResponse)
-def init_payment(payload: PaymentInitRequest):
+async def init_payment(payload: PaymentInitRequest, request: Request):
     """
     Initialize payment. Supports two methods:
-    - card: Paystack (live if key set, else simulated)
+    - card: Paystack (live if key set, 502 if Paystack fails; else simulated)
     - bank_transfer: returns manual bank details for transfer
+
+    Orders are saved after /orders responds, so an order_id used immediately
+    can briefly return 404 until that insert completes.
     """
     order_id = payload.order_id
     method = payload.payment_method
@@ -142,10 +295,9 @@ def init_payment(payload: PaymentInitRequest):
     # Fetch order
     if db is None:
         raise HTTPException(status_code=500, detail="Database not configured")
-    try:
-        doc = db["order"].find_one({"_id": ObjectId(order_id)})
-    except Exception:
-        doc = None
+    if not ObjectId.is_valid(order_id):
+        raise HTTPException(status_code=400, detail="Invalid order_id")
+    doc = await db["order"].find_one({"_id": ObjectId(order_id)})
     if not doc:
         raise HTTPException(status_code=404, detail="Order not found")
 
@@ -171,40 +323,43 @@ def init_payment(payload: PaymentInitRequest):
         )
 
     # method == "card"
-    secret_key = os.getenv("PAYSTACK_SECRET_KEY")
-    if secret_key:
-        # Live mode with Paystack
+    if PAYSTACK_SECRET_KEY:
+        # Live mode with Paystack; failures are reported, never simulated
+        ref = f"HF-{order_id}"
+        payload_json = {
+            "email": email,
+            "amount": to_kobo(total_amount),
+            "reference": ref,
+            "currency": "NGN",
+        }
+        headers = {
+            "Authorization": f"Bearer {PAYSTACK_SECRET_KEY}",
+            "Content-Type": "application/json",
+        }
         try:
-            ref = f"HF-{order_id}"
-            payload_json = {
-                "email": email,
-                "amount": int(total_amount * 100),  # Kobo
-                "reference": ref,
-                "currency": "NGN",
-            }
-            headers = {
-                "Authorization": f"Bearer {secret_key}",
-                "Content-Type": "application/json",
-            }
-            res = requests.post(
+            res = await _paystack_post(
+                request.app.state.http,
                 "https://api.paystack.co/transaction/initialize",
                 json=payload_json,
                 headers=headers,
-                timeout=10,
-            )
-            data = res.json()
-            if not data.get("status"):
-                raise HTTPException(status_code=502, detail=f"Paystack error: {data.get('message')}")
-            auth_url = data["data"]["authorization_url"]
-            return PaymentInitResponse(
-                mode="live",
-                reference=ref,
-                payment_method="card",
-                authorization_url=auth_url,
             )
-        except Exception:
-            # Fallback to simulated
-            pass
+            data = orjson.loads(res.content)
+        except (httpx.HTTPError, orjson.JSONDecodeError) as e:
+            raise HTTPException(status_code=502, detail=f"Paystack unavailable: {str(e)[:80]}")
+        if not isinstance(data, dict):
+            raise HTTPException(status_code=502, detail="Paystack error: unexpected response")
+        if not data.get("status"):
+            raise HTTPException(status_code=502, detail=f"Paystack error: {data.get('message')}")
+        result = data.get("data")
+        auth_url = result.get("authorization_url") if isinstance(result, dict) else None
+        if not auth_url:
+            raise HTTPException(status_code=502, detail="Paystack error: missing authorization_url")
+        return PaymentInitResponse(
+            mode="live",
+            reference=ref,
+            payment_method="card",
+            authorization_url=auth_url,
+        )
 
     # Simulated card mode
     reference = f"HF-{order_id}"
@@ -217,37 +372,48 @@ def init_payment(payload: PaymentInitRequest):
     )
 
 @app.get("/payments/verify", response_model=PaymentVerifyResponse)
-def verify_payment(reference: str):
+async def verify_payment(reference: str, request: Request):
     """
-    Verifies payment. If PAYSTACK_SECRET_KEY is set, calls Paystack verify; else simulated success.
+    Verifies payment. If PAYSTACK_SECRET_KEY is set, calls Paystack verify (502 if unreachable);
+    else simulated success.
     """
-    secret_key = os.getenv("PAYSTACK_SECRET_KEY")
-    if secret_key:
+    if PAYSTACK_SECRET_KEY:
+        headers = {
+            "Authorization": f"Bearer {PAYSTACK_SECRET_KEY}",
+            "Content-Type": "application/json",
+        }
         try:
-            headers = {
-                "Authorization": f"Bearer {secret_key}",
-                "Content-Type": "application/json",
-            }
-            res = requests.get(
+            res = await _paystack_get(
+                request.app.state.http,
                 f"https://api.paystack.co/transaction/verify/{reference}",
                 headers=headers,
-                timeout=10,
             )
-            data = res.json()
-            status = "failed"
-            paid = False
-            if data.get("status") and data.get("data", {}).get("status") == "success":
-                status = "success"
-                paid = True
-            return PaymentVerifyResponse(status=status, order_status=("paid" if paid else "failed"), reference=reference, paid=paid)
-        except Exception:
-            # fall through to simulated
-            pass
+            data = orjson.loads(res.content)
+        except (httpx.HTTPError, orjson.JSONDecodeError) as e:
+            # Never report a simulated success while live mode is configured
+            raise HTTPException(status_code=502, detail=f"Paystack unavailable: {str(e)[:80]}")
+        if not isinstance(data, dict):
+            raise HTTPException(status_code=502, detail="Paystack error: unexpected response")
+        result = data.get("data")
+        paid = bool(data.get("status")) and isinstance(result, dict) and result.get("status") == "success"
+        return PaymentVerifyResponse(
+            status=("success" if paid else "failed"),
+            order_status=("paid" if paid else "failed"),
+            reference=reference,
+            paid=paid,
+        )
     # Simulated success by default
     return PaymentVerifyResponse(status="success", order_status="paid", reference=reference, paid=True)
 
 
 if __name__ == "__main__":
     import uvicorn
-    port = int(os.getenv("PORT", 8000))
-    uvicorn.run(app, host="0.0.0.0", port=port)
+    # Workers need an import string rather than the app object
+    uvicorn.run(
+        "main:app",
+        host="0.0.0.0",
+        port=PORT,
+        loop="uvloop",
+        http="httptools",
+        workers=int(os.getenv("WEB_CONCURRENCY", os.cpu_count() or 2)),
+    )
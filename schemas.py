@@ -11,7 +11,7 @@ Model name is converted to lowercase for the collection name:
 - BlogPost -> "blogs" collection
 """
 
-from pydantic import BaseModel, Field, EmailStr
+from pydantic import BaseModel, Field, EmailStr, TypeAdapter
 from typing import Optional, List, Literal
 
 # Example schemas (replace with your own):
@@ -59,7 +59,15 @@ class OrderCreate(BaseModel):
     delivery_fee: float = Field(..., ge=0)
     total: float = Field(..., ge=0)
 
+# Prebuilt validator for validating raw order payloads outside of a route
+ORDER_CREATE_ADAPTER = TypeAdapter(OrderCreate)
+
 class Order(BaseModel):
+    """
+    Orders collection schema
+    Collection name: "order"
+    Indexes: payment_reference (sparse, created on startup)
+    """
     items: List[OrderItem]
     customer: CustomerInfo
     subtotal: float
@@ -89,6 +97,16 @@ class PaymentVerifyResponse(BaseModel):
     reference: str
     paid: bool
 
+# Delivery ETA
+
+class EtaPair(BaseModel):
+    city: str
+    hub: str = "Lagos"
+
+class EtaBatchRequest(BaseModel):
+    # Bounded: per-pair parsing and response building dominate request cost
+    pairs: List[EtaPair] = Field(..., max_length=1000)
+
 # Note: The Flames database viewer will automatically:
 # 1. Read these schemas from GET /schema endpoint
 # 2. Use them for document validation when creating/editing